@@ -1,8 +1,27 @@
 """Downloads media from telegram."""
 import asyncio
+import functools
+import inspect
 import logging
+import math
 import os
-from typing import List, Optional, Tuple, Union
+import random
+import shutil
+import stat
+import tempfile
+import time
+from typing import (
+    AsyncIterator,
+    Collection,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import pyrogram
 import yaml
@@ -14,6 +33,18 @@ from utils.log import LogFilter
 from utils.meta import print_meta
 from utils.updates import check_for_updates
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    from yaml import CSafeDumper as YamlDumper
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeDumper as YamlDumper  # type: ignore
+    from yaml import SafeLoader as YamlLoader  # type: ignore
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(message)s",
@@ -25,8 +56,88 @@ logging.getLogger("pyrogram.client").addFilter(LogFilter())
 logger = logging.getLogger("media_downloader")
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
-FAILED_IDS: list = []
-DOWNLOADED_IDS: list = []
+CONFIG_FILE = os.path.join(THIS_DIR, "config.yaml")
+FAILED_IDS: Set[int] = set()
+DOWNLOADED_IDS: Set[int] = set()
+CREATED_DIRS: Set[str] = set()
+# pyrogram streams media in chunks of 1 MiB.
+CHUNK_SIZE: int = 1024 * 1024
+# Files smaller than this are fetched with a single `download_media` call.
+PARALLEL_DOWNLOAD_THRESHOLD: int = 20 * CHUNK_SIZE
+PARALLEL_DOWNLOAD_WORKERS: int = 4
+# Number of messages of a batch being downloaded at the same time.
+MAX_CONCURRENT_DOWNLOADS: int = 6
+# Delay in seconds before the first download retry, doubled on each retry.
+RETRY_BASE_DELAY: float = 5.0
+RETRY_MAX_DELAY: float = 60.0
+# Minimum number of seconds between two config writes during an import.
+CONFIG_WRITE_INTERVAL: float = 30.0
+# Serialized config of the last write, used to skip rewriting unchanged state.
+_LAST_WRITTEN_CONFIG: Optional[str] = None
+
+
+def _serialize_config(config: dict) -> str:
+    """
+    Merge the download state into the configuration and serialize it.
+
+    Parameters
+    ----------
+    config: dict
+        Configuration to be written into config file.
+
+    Returns
+    -------
+    str
+        YAML document of the configuration.
+    """
+    config["ids_to_retry"] = sorted(
+        (set(config["ids_to_retry"]) | FAILED_IDS) - DOWNLOADED_IDS
+    )
+    config_yaml: str = yaml.dump(config, Dumper=YamlDumper, default_flow_style=False)
+    return config_yaml
+
+
+def _write_config(config_yaml: str):
+    """
+    Write a serialized configuration to the config file.
+
+    The file is left untouched when the serialized configuration is the
+    same as the one written last. Only does blocking file IO, so it is
+    safe to run in an executor.
+
+    The configuration is written to a temporary file next to the real
+    config file, symlinks resolved, which takes over the mode of the
+    config file before being swapped in.
+
+    Parameters
+    ----------
+    config_yaml: str
+        YAML document of the configuration.
+    """
+    # pylint: disable = W0603
+    global _LAST_WRITTEN_CONFIG
+    if config_yaml == _LAST_WRITTEN_CONFIG:
+        return
+    # Write to a temporary file and swap it in, so an interrupted write
+    # never leaves a truncated config behind.
+    config_file: str = os.path.realpath(CONFIG_FILE)
+    temp_fd, temp_config_file = tempfile.mkstemp(
+        prefix=f"{os.path.basename(config_file)}.",
+        suffix=".tmp",
+        dir=os.path.dirname(config_file),
+    )
+    try:
+        with os.fdopen(temp_fd, "w") as yaml_file:
+            yaml_file.write(config_yaml)
+        # The config holds the api_hash, keep its permissions.
+        if os.path.exists(config_file):
+            shutil.copymode(config_file, temp_config_file)
+        os.replace(temp_config_file, config_file)
+    except BaseException:
+        os.remove(temp_config_file)
+        raise
+    _LAST_WRITTEN_CONFIG = config_yaml
+    logger.info("Updated last read message_id to config file")
 
 
 def update_config(config: dict):
@@ -38,12 +149,7 @@ def update_config(config: dict):
     config: dict
         Configuration to be written into config file.
     """
-    config["ids_to_retry"] = (
-        list(set(config["ids_to_retry"]) - set(DOWNLOADED_IDS)) + FAILED_IDS
-    )
-    with open("config.yaml", "w") as yaml_file:
-        yaml.dump(config, yaml_file, default_flow_style=False)
-    logger.info("Updated last read message_id to config file")
+    _write_config(_serialize_config(config))
 
 
 def _can_download(_type: str, file_formats: dict, file_format: Optional[str]) -> bool:
@@ -55,7 +161,7 @@ def _can_download(_type: str, file_formats: dict, file_format: Optional[str]) ->
     _type: str
         Type of media object.
     file_formats: dict
-        Dictionary containing the list of file_formats
+        Dictionary containing the collection of file_formats
         to be downloaded for `audio`, `document` & `video`
         media types
     file_format: str
@@ -67,30 +173,111 @@ def _can_download(_type: str, file_formats: dict, file_format: Optional[str]) ->
         True if the file format can be downloaded else False.
     """
     if _type in ["audio", "document", "video"]:
-        allowed_formats: list = file_formats[_type]
-        if not file_format in allowed_formats and allowed_formats[0] != "all":
+        allowed_formats: Collection[str] = file_formats[_type]
+        if file_format not in allowed_formats and "all" not in allowed_formats:
             return False
     return True
 
 
-def _is_exist(file_path: str) -> bool:
+def _stat_file(file_path: str) -> Optional[os.stat_result]:
     """
-    Check if a file exists and it is not a directory.
+    Stat a file which is not a directory.
 
     Parameters
     ----------
     file_path: str
         Absolute path of the file to be checked.
 
+    Returns
+    -------
+    Optional[os.stat_result]
+        Status of the file, None if it does not exist or is a directory.
+    """
+    try:
+        file_stat: os.stat_result = os.stat(file_path)
+    except (OSError, ValueError):
+        return None
+    if stat.S_ISDIR(file_stat.st_mode):
+        return None
+    return file_stat
+
+
+def _would_be_duplicate(
+    file_stat: Optional[os.stat_result], file_size: Optional[int]
+) -> bool:
+    """
+    Check if a media is already downloaded to its path.
+
+    The existing file is treated as the same media when its size
+    matches the size reported by Telegram, so the download and the
+    md5 comparison of `manage_duplicate_file` can be skipped.
+
+    Parameters
+    ----------
+    file_stat: Optional[os.stat_result]
+        Status of the file at the download path, as returned by
+        `_stat_file`.
+    file_size: Optional[int]
+        Size of the media in bytes as reported by Telegram.
+
     Returns
     -------
     bool
-        True if the file exists else False.
+        True if a regular file of the same size exists else False.
+    """
+    if not file_size or file_stat is None:
+        return False
+    return stat.S_ISREG(file_stat.st_mode) and file_stat.st_size == file_size
+
+
+@functools.lru_cache(maxsize=None)
+def _get_media_dir(base_dir: str, _type: str) -> str:
+    """
+    Get the download directory of a media type, with a trailing separator.
+
+    Parameters
+    ----------
+    base_dir: str
+        Absolute path of the directory the media are downloaded to.
+    _type: str
+        Type of media object.
+
+    Returns
+    -------
+    str
+        Absolute path of the directory for the media type.
+    """
+    return os.path.join(base_dir, _type, "")
+
+
+def _get_message_media(
+    message: pyrogram.types.Message, media_types: Iterable[str]
+) -> Tuple[str, Optional[Union[Audio, Document, Photo, Video, VideoNote, Voice]]]:
+    """
+    Get the media object of a message if it is of a requested type.
+
+    Parameters
+    ----------
+    message: pyrogram.types.Message
+        Message object retrieved from telegram.
+    media_types: iterable
+        Collection of strings of media types to be downloaded.
+
+    Returns
+    -------
+    Tuple[str, Optional[Union[Audio, Document, Photo, Video, VideoNote, Voice]]]
+        media type, media object or None if there is nothing to download.
     """
-    return not os.path.isdir(file_path) and os.path.exists(file_path)
+    if message.media is not None:
+        for _type in media_types:
+            _media = getattr(message, _type, None)
+            # A message carries a single media object.
+            if _media is not None:
+                return _type, _media
+    return "", None
 
 
-async def _get_media_meta(
+def _get_media_meta(
     media_obj: Union[Audio, Document, Photo, Video, VideoNote, Voice],
     _type: str,
 ) -> Tuple[str, Optional[str]]:
@@ -117,33 +304,195 @@ async def _get_media_meta(
     if _type in ["voice", "video_note"]:
         # pylint: disable = C0209
         file_format = media_obj.mime_type.split("/")[-1]  # type: ignore
-        file_name: str = os.path.join(
-            THIS_DIR,
+        file_name: str = _get_media_dir(THIS_DIR, _type) + "{}_{}.{}".format(
             _type,
-            "{}_{}.{}".format(
-                _type,
-                media_obj.date.isoformat(),  # type: ignore
-                file_format,
-            ),
+            media_obj.date.isoformat(),  # type: ignore
+            file_format,
         )
     else:
-        file_name = os.path.join(
-            THIS_DIR, _type, getattr(media_obj, "file_name", None) or ""
+        file_name = _get_media_dir(THIS_DIR, _type) + (
+            getattr(media_obj, "file_name", None) or ""
         )
     return file_name, file_format
 
 
+async def _ensure_dir(directory: str):
+    """
+    Create a directory, without blocking the event loop.
+
+    Directories created once are remembered and not checked again.
+
+    Parameters
+    ----------
+    directory: str
+        Absolute path of the directory to be created.
+    """
+    if directory in CREATED_DIRS:
+        return
+    await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(os.makedirs, directory, exist_ok=True)
+    )
+    CREATED_DIRS.add(directory)
+
+
+async def _parallel_download(
+    client: pyrogram.client.Client,
+    message: pyrogram.types.Message,
+    file_name: str,
+    file_size: int,
+    workers: int = PARALLEL_DOWNLOAD_WORKERS,
+) -> str:
+    """
+    Download a media file as several concurrent chunk ranges.
+
+    The file is preallocated to `file_size` and every worker streams
+    its own range of chunks into place. The data is written to a
+    temporary file which is moved to `file_name` once complete.
+
+    pyrogram ends a stream early, without raising, when fetching a
+    chunk fails. A range that comes back short fails the whole
+    download rather than leaving zeroes in the file.
+
+    Parameters
+    ----------
+    client: pyrogram.client.Client
+        Client to interact with Telegram APIs.
+    message: pyrogram.types.Message
+        Message object containing the media to be downloaded.
+    file_name: str
+        Absolute path of the file to be written.
+    file_size: int
+        Size of the media in bytes.
+    workers: int
+        Number of chunk ranges to be downloaded concurrently.
+
+    Returns
+    -------
+    str
+        Absolute path of the downloaded file.
+
+    Raises
+    ------
+    ConnectionError
+        If a chunk range was not downloaded completely.
+    """
+    total_chunks: int = math.ceil(file_size / CHUNK_SIZE)
+    chunks_per_worker: int = math.ceil(total_chunks / workers)
+    temp_file_name: str = f"{file_name}.temp"
+    await _ensure_dir(os.path.dirname(file_name))
+    with open(temp_file_name, "wb") as temp_file:
+        temp_file.truncate(file_size)
+
+    loop = asyncio.get_running_loop()
+
+    async def _download_range(first_chunk: int):
+        range_start: int = first_chunk * CHUNK_SIZE
+        range_size: int = min(chunks_per_worker * CHUNK_SIZE, file_size - range_start)
+        written: int = 0
+        with open(temp_file_name, "r+b") as part_file:
+            part_file.seek(range_start)
+            async for chunk in client.stream_media(  # type: ignore
+                message, limit=chunks_per_worker, offset=first_chunk
+            ):
+                # Let the disk drain in a worker thread while the other
+                # ranges keep receiving chunks.
+                await loop.run_in_executor(None, part_file.write, chunk)
+                written += len(chunk)
+        if written != range_size:
+            raise ConnectionError(
+                f"Downloaded {written} of {range_size} bytes "
+                f"from offset {range_start} of {file_name}"
+            )
+
+    range_downloads: list = [
+        asyncio.ensure_future(_download_range(first_chunk))
+        for first_chunk in range(0, total_chunks, chunks_per_worker)
+    ]
+    try:
+        await asyncio.gather(*range_downloads)
+    except BaseException:
+        # Stop the other ranges before their file is removed.
+        for range_download in range_downloads:
+            range_download.cancel()
+        await asyncio.gather(*range_downloads, return_exceptions=True)
+        os.remove(temp_file_name)
+        raise
+    os.replace(temp_file_name, file_name)
+    return file_name
+
+
+async def _download_file(
+    client: pyrogram.client.Client,
+    message: pyrogram.types.Message,
+    media_obj: Union[Audio, Document, Photo, Video, VideoNote, Voice],
+    file_name: str,
+) -> Optional[str]:
+    """
+    Download the media of a message to the given file name.
+
+    Large files with a known name are downloaded in parallel chunk
+    ranges when the client lets several transmissions run at once,
+    everything else is left to `client.download_media`.
+
+    Parameters
+    ----------
+    client: pyrogram.client.Client
+        Client to interact with Telegram APIs.
+    message: pyrogram.types.Message
+        Message object retrieved from telegram.
+    media_obj: Union[Audio, Document, Photo, Video, VideoNote, Voice]
+        Media object of the message.
+    file_name: str
+        Absolute path of the file to be downloaded.
+
+    Returns
+    -------
+    Optional[str]
+        Absolute path of the downloaded file.
+    """
+    file_size: int = getattr(media_obj, "file_size", None) or 0
+    if (
+        file_size >= PARALLEL_DOWNLOAD_THRESHOLD
+        and os.path.basename(file_name)
+        and getattr(client, "max_concurrent_transmissions", 1) > 1
+    ):
+        return await _parallel_download(client, message, file_name, file_size)
+    return await client.download_media(message, file_name=file_name)  # type: ignore
+
+
+def _get_retry_delay(retry: int) -> float:
+    """
+    Get the delay before the next download attempt.
+
+    The delay doubles on every retry, capped at `RETRY_MAX_DELAY`,
+    with a +/-10% jitter so that failed downloads of a batch do not
+    all hit Telegram again at the same instant.
+
+    Parameters
+    ----------
+    retry: int
+        Zero based index of the attempt that just failed.
+
+    Returns
+    -------
+    float
+        Number of seconds to wait.
+    """
+    delay: float = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**retry)
+    return delay * random.uniform(0.9, 1.1)
+
+
 async def download_media(
     client: pyrogram.client.Client,
     message: pyrogram.types.Message,
-    media_types: List[str],
+    media_types: Iterable[str],
     file_formats: dict,
-):
+) -> int:
     """
     Download media from Telegram.
 
-    Each of the files to download are retried 3 times with a
-    delay of 5 seconds each.
+    Each of the files to download are retried 3 times with an
+    exponentially growing, jittered delay between attempts.
 
     Parameters
     ----------
@@ -151,8 +500,8 @@ async def download_media(
         Client to interact with Telegram APIs.
     message: pyrogram.types.Message
         Message object retrieved from telegram.
-    media_types: list
-        List of strings of media types to be downloaded.
+    media_types: iterable
+        Collection of strings of media types to be downloaded.
         Ex : `["audio", "photo"]`
         Supported formats:
             * audio
@@ -161,7 +510,7 @@ async def download_media(
             * video
             * voice
     file_formats: dict
-        Dictionary containing the list of file_formats
+        Dictionary containing the collection of file_formats
         to be downloaded for `audio`, `document` & `video`
         media types.
 
@@ -170,60 +519,71 @@ async def download_media(
     int
         Current message id.
     """
+    # The media type and metadata do not change when the message is
+    # refetched on retries, look them up once.
+    _type, _media = _get_message_media(message, media_types)
+    if _media is None:
+        return message.id
+    file_name: Optional[str] = None
     for retry in range(3):
         try:
-            if message.media is None:
-                return message.id
-            for _type in media_types:
-                _media = getattr(message, _type, None)
-                if _media is None:
-                    continue
-                file_name, file_format = await _get_media_meta(_media, _type)
-                if _can_download(_type, file_formats, file_format):
-                    if _is_exist(file_name):
-                        file_name = get_next_name(file_name)
-                        download_path = await client.download_media(
-                            message, file_name=file_name
-                        )
-                        # pylint: disable = C0301
-                        download_path = manage_duplicate_file(download_path)  # type: ignore
-                    else:
-                        download_path = await client.download_media(
-                            message, file_name=file_name
-                        )
-                    if download_path:
-                        logger.info("Media downloaded - %s", download_path)
-                    DOWNLOADED_IDS.append(message.id)
+            # Computed on the first attempt only, inside the try so a bad
+            # mime type fails just this message.
+            if file_name is None:
+                file_name, file_format = _get_media_meta(_media, _type)
+                if not _can_download(_type, file_formats, file_format):
+                    break
+            file_stat: Optional[os.stat_result] = _stat_file(file_name)
+            if _would_be_duplicate(file_stat, getattr(_media, "file_size", None)):
+                logger.info("Media already downloaded - %s", file_name)
+                DOWNLOADED_IDS.add(message.id)
+                break
+            if file_stat is not None:
+                download_path = await _download_file(
+                    client, message, _media, get_next_name(file_name)
+                )
+                # pylint: disable = C0301
+                download_path = manage_duplicate_file(download_path)  # type: ignore
+            else:
+                download_path = await _download_file(client, message, _media, file_name)
+            if download_path:
+                logger.info("Media downloaded - %s", download_path)
+            DOWNLOADED_IDS.add(message.id)
             break
         except pyrogram.errors.exceptions.bad_request_400.BadRequest:
+            if retry == 2:
+                # pylint: disable = C0301
+                logger.error(
+                    "Message[%d]: file reference expired for 3 retries, download skipped.",
+                    message.id,
+                )
+                FAILED_IDS.add(message.id)
+                break
             logger.warning(
                 "Message[%d]: file reference expired, refetching...",
                 message.id,
             )
+            await asyncio.sleep(_get_retry_delay(retry))
             message = await client.get_messages(  # type: ignore
                 chat_id=message.chat.id,  # type: ignore
                 message_ids=message.id,
             )
+        except (TypeError, ConnectionError):
             if retry == 2:
-                # pylint: disable = C0301
                 logger.error(
-                    "Message[%d]: file reference expired for 3 retries, download skipped.",
+                    "Message[%d]: Timing out after 3 reties, download skipped.",
                     message.id,
                 )
-                FAILED_IDS.append(message.id)
-        except TypeError:
+                FAILED_IDS.add(message.id)
+                break
             # pylint: disable = C0301
+            retry_delay: float = _get_retry_delay(retry)
             logger.warning(
-                "Timeout Error occurred when downloading Message[%d], retrying after 5 seconds",
+                "Timeout Error occurred when downloading Message[%d], retrying after %.1f seconds",
                 message.id,
+                retry_delay,
             )
-            await asyncio.sleep(5)
-            if retry == 2:
-                logger.error(
-                    "Message[%d]: Timing out after 3 reties, download skipped.",
-                    message.id,
-                )
-                FAILED_IDS.append(message.id)
+            await asyncio.sleep(retry_delay)
         except Exception as e:
             # pylint: disable = C0301
             logger.error(
@@ -232,7 +592,7 @@ async def download_media(
                 e,
                 exc_info=True,
             )
-            FAILED_IDS.append(message.id)
+            FAILED_IDS.add(message.id)
             break
     return message.id
 
@@ -240,8 +600,9 @@ async def download_media(
 async def process_messages(
     client: pyrogram.client.Client,
     messages: List[pyrogram.types.Message],
-    media_types: List[str],
+    media_types: Iterable[str],
     file_formats: dict,
+    max_concurrent_downloads: int = MAX_CONCURRENT_DOWNLOADS,
 ) -> int:
     """
     Download media from Telegram.
@@ -252,8 +613,8 @@ async def process_messages(
         Client to interact with Telegram APIs.
     messages: list
         List of telegram messages.
-    media_types: list
-        List of strings of media types to be downloaded.
+    media_types: iterable
+        Collection of strings of media types to be downloaded.
         Ex : `["audio", "photo"]`
         Supported formats:
             * audio
@@ -262,26 +623,97 @@ async def process_messages(
             * video
             * voice
     file_formats: dict
-        Dictionary containing the list of file_formats
+        Dictionary containing the collection of file_formats
         to be downloaded for `audio`, `document` & `video`
         media types.
+    max_concurrent_downloads: int
+        Maximum number of messages downloaded at the same time.
 
     Returns
     -------
     int
         Max value of list of message ids.
     """
-    message_ids = await asyncio.gather(
-        *[
-            download_media(client, message, media_types, file_formats)
-            for message in messages
-        ]
-    )
-
-    last_message_id: int = max(message_ids)
+    semaphore = asyncio.Semaphore(max_concurrent_downloads)
+
+    async def _download_with_limit(message: pyrogram.types.Message) -> int:
+        async with semaphore:
+            return await download_media(client, message, media_types, file_formats)
+
+    tasks = [
+        asyncio.ensure_future(_download_with_limit(message)) for message in messages
+    ]
+    last_message_id: int = 0
+    try:
+        # Track the highest id as downloads finish, no result list needed.
+        for next_done in asyncio.as_completed(tasks):
+            last_message_id = max(last_message_id, await next_done)
+    finally:
+        for task in tasks:
+            task.cancel()
     return last_message_id
 
 
+async def _fetch_batch(
+    messages_iter: AsyncIterator[pyrogram.types.Message], pagination_limit: int
+) -> List[pyrogram.types.Message]:
+    """
+    Fetch the next batch of messages from the chat history.
+
+    Parameters
+    ----------
+    messages_iter: AsyncIterator[pyrogram.types.Message]
+        Iterator over the chat history.
+    pagination_limit: int
+        Maximum number of messages in the batch.
+
+    Returns
+    -------
+    List[pyrogram.types.Message]
+        Next batch of messages, empty once the history is exhausted.
+    """
+    messages_list: list = []
+    async for message in messages_iter:
+        messages_list.append(message)
+        if len(messages_list) >= pagination_limit:
+            break
+    return messages_list
+
+
+def _get_max_concurrent_downloads(config: dict) -> int:
+    """
+    Read the number of concurrent downloads from the configuration.
+
+    Parameters
+    ----------
+    config: dict
+        Configuration read from the config file.
+
+    Returns
+    -------
+    int
+        Number of messages of a batch to be downloaded at the same time.
+
+    Raises
+    ------
+    ValueError
+        If `max_concurrent_downloads` is not a positive integer.
+    """
+    max_concurrent_downloads = config.get(
+        "max_concurrent_downloads", MAX_CONCURRENT_DOWNLOADS
+    )
+    if (
+        not isinstance(max_concurrent_downloads, int)
+        or isinstance(max_concurrent_downloads, bool)
+        or max_concurrent_downloads < 1
+    ):
+        raise ValueError(
+            "max_concurrent_downloads in config.yaml must be an integer of at "
+            f"least 1, got {max_concurrent_downloads!r}"
+        )
+    return max_concurrent_downloads
+
+
 async def begin_import(config: dict, pagination_limit: int) -> dict:
     """
     Create pyrogram client and initiate download.
@@ -302,51 +734,87 @@ async def begin_import(config: dict, pagination_limit: int) -> dict:
     dict
         Updated configuration to be written into config file.
     """
+    max_concurrent_downloads: int = _get_max_concurrent_downloads(config)
+    client_options: dict = {}
+    # Only newer pyrogram releases limit concurrent transmissions, and
+    # the pinned fork may predate the option.
+    if "max_concurrent_transmissions" in inspect.signature(pyrogram.Client).parameters:
+        # Let the concurrent downloads, and the chunk ranges of a parallel
+        # download, stream at once.
+        client_options["max_concurrent_transmissions"] = max(
+            max_concurrent_downloads, PARALLEL_DOWNLOAD_WORKERS
+        )
     client = pyrogram.Client(
         "media_downloader",
         api_id=config["api_id"],
         api_hash=config["api_hash"],
         proxy=config.get("proxy"),
+        **client_options,
     )
     await client.start()
     last_read_message_id: int = config["last_read_message_id"]
-    messages_iter = client.get_chat_history(
+    messages_iter = client.get_chat_history(  # type: ignore
         config["chat_id"], offset_id=last_read_message_id, reverse=True
     )
     messages_list: list = []
-    pagination_count: int = 0
     if config["ids_to_retry"]:
         logger.info("Downloading files failed during last run...")
         skipped_messages: list = await client.get_messages(  # type: ignore
             chat_id=config["chat_id"], message_ids=config["ids_to_retry"]
         )
-        for message in skipped_messages:
-            pagination_count += 1
-            messages_list.append(message)
-
-    async for message in messages_iter:  # type: ignore
-        if pagination_count != pagination_limit:
-            pagination_count += 1
-            messages_list.append(message)
-        else:
-            last_read_message_id = await process_messages(
-                client,
-                messages_list,
-                config["media_types"],
-                config["file_formats"],
+        messages_list.extend(skipped_messages)
+
+    # Membership checks on these run for every message, use sets.
+    media_types: FrozenSet[str] = frozenset(config["media_types"])
+    file_formats: Dict[str, FrozenSet[str]] = {
+        _type: frozenset(formats) for _type, formats in config["file_formats"].items()
+    }
+    # Create the download directories up front rather than once per file.
+    await asyncio.gather(
+        *[_ensure_dir(os.path.join(THIS_DIR, _type)) for _type in media_types]
+    )
+    loop = asyncio.get_running_loop()
+    last_config_write: float = time.monotonic()
+    config_write: Optional[asyncio.Future] = None
+    try:
+        if len(messages_list) < pagination_limit:
+            messages_list += await _fetch_batch(
+                messages_iter, pagination_limit - len(messages_list)  # type: ignore
             )
-            pagination_count = 0
-            messages_list = []
-            messages_list.append(message)
+        while messages_list:
+            # Page in the next batch while the current one downloads.
+            next_batch = asyncio.ensure_future(
+                _fetch_batch(messages_iter, pagination_limit)  # type: ignore
+            )
+            try:
+                last_read_message_id = await process_messages(
+                    client,
+                    messages_list,
+                    media_types,
+                    file_formats,
+                    max_concurrent_downloads,
+                )
+            except BaseException:
+                next_batch.cancel()
+                raise
             config["last_read_message_id"] = last_read_message_id
-            update_config(config)
-    if messages_list:
-        last_read_message_id = await process_messages(
-            client,
-            messages_list,
-            config["media_types"],
-            config["file_formats"],
-        )
+            if time.monotonic() - last_config_write >= CONFIG_WRITE_INTERVAL:
+                # Serialize on the loop, where the state is mutated, and
+                # leave only the file IO to the executor.
+                config_write = loop.run_in_executor(
+                    None, _write_config, _serialize_config(config)
+                )
+                # A cancelled await does not stop the worker thread, keep
+                # the write alive so the final write below can wait for it.
+                await asyncio.shield(config_write)
+                last_config_write = time.monotonic()
+            messages_list = await next_batch
+    except BaseException:
+        if config_write is not None and not config_write.done():
+            await asyncio.wait({config_write})
+        # Checkpoints are debounced, persist the progress made so far.
+        update_config(config)
+        raise
 
     await client.stop()
     config["last_read_message_id"] = last_read_message_id
@@ -355,17 +823,22 @@ async def begin_import(config: dict, pagination_limit: int) -> dict:
 
 def main():
     """Main function of the downloader."""
-    with open(os.path.join(THIS_DIR, "config.yaml")) as f:
-        config = yaml.safe_load(f)
-    updated_config = asyncio.get_event_loop().run_until_complete(
-        begin_import(config, pagination_limit=100)
-    )
+    # pylint: disable = W0603
+    global _LAST_WRITTEN_CONFIG
+    with open(CONFIG_FILE) as f:
+        config = yaml.load(f, Loader=YamlLoader)
+    # Treat the configuration as read as already written, so a run that
+    # changes nothing leaves the config file untouched.
+    _LAST_WRITTEN_CONFIG = _serialize_config(config)
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    updated_config = asyncio.run(begin_import(config, pagination_limit=100))
     if FAILED_IDS:
         logger.info(
             "Downloading of %d files failed. "
             "Failed message ids are added to config file.\n"
             "These files will be downloaded on the next run.",
-            len(set(FAILED_IDS)),
+            len(FAILED_IDS),
         )
     update_config(updated_config)
     check_for_updates()
@@ -3,16 +3,28 @@ import asyncio
 import copy
 import os
 import platform
+import stat
+import tempfile
+import threading
+import time
 import unittest
 from datetime import datetime
 
 import mock
 import pyrogram
 
+import media_downloader
 from media_downloader import (
     _can_download,
+    _download_file,
+    _ensure_dir,
+    _get_max_concurrent_downloads,
     _get_media_meta,
-    _is_exist,
+    _get_message_media,
+    _get_retry_delay,
+    _parallel_download,
+    _stat_file,
+    _would_be_duplicate,
     begin_import,
     download_media,
     main,
@@ -20,9 +32,13 @@ from media_downloader import (
     update_config,
 )
 
+IS_WINDOWS: bool = platform.system() == "Windows"
 MOCK_DIR: str = "/root/project"
-if platform.system() == "Windows":
+if IS_WINDOWS:
     MOCK_DIR = "\\root\\project"
+MOCK_VOICE_DATE: datetime = datetime(2019, 7, 25, 14, 53, 50)
+MOCK_PHOTO_DATE: datetime = datetime(2019, 8, 5, 14, 35, 12)
+MOCK_FILE_CONTENT: bytes = b"0123456789abcdefghijklmnopqrstuvwxyz"
 MOCK_CONF = {
     "api_id": 123,
     "api_hash": "hasw5Tgawsuj67",
@@ -36,7 +52,7 @@ MOCK_CONF = {
 
 def platform_generic_path(_path: str) -> str:
     platform_specific_path: str = _path
-    if platform.system() == "Windows":
+    if IS_WINDOWS:
         platform_specific_path = platform_specific_path.replace("/", "\\")
     return platform_specific_path
 
@@ -46,11 +62,25 @@ def mock_manage_duplicate_file(file_path: str) -> str:
 
 
 class Chat:
+    __slots__ = ("id",)
+
     def __init__(self, chat_id):
         self.id = chat_id
 
 
 class MockMessage:
+    __slots__ = (
+        "id",
+        "media",
+        "audio",
+        "document",
+        "photo",
+        "video",
+        "voice",
+        "video_note",
+        "chat",
+    )
+
     def __init__(self, **kwargs):
         self.id = kwargs.get("id")
         self.media = kwargs.get("media")
@@ -64,79 +94,184 @@ class MockMessage:
 
 
 class MockAudio:
+    __slots__ = ("file_name", "mime_type")
+
     def __init__(self, **kwargs):
         self.file_name = kwargs["file_name"]
         self.mime_type = kwargs["mime_type"]
 
 
 class MockDocument:
+    __slots__ = ("file_name", "mime_type", "file_size")
+
     def __init__(self, **kwargs):
         self.file_name = kwargs["file_name"]
         self.mime_type = kwargs["mime_type"]
+        self.file_size = kwargs.get("file_size", None)
 
 
 class MockPhoto:
+    __slots__ = ("date",)
+
     def __init__(self, **kwargs):
         self.date = kwargs["date"]
 
 
 class MockVoice:
+    __slots__ = ("mime_type", "date")
+
     def __init__(self, **kwargs):
         self.mime_type = kwargs["mime_type"]
         self.date = kwargs["date"]
 
 
 class MockVideo:
+    __slots__ = ("mime_type",)
+
     def __init__(self, **kwargs):
         self.mime_type = kwargs["mime_type"]
 
 
 class MockVideoNote:
+    __slots__ = ("mime_type", "date")
+
     def __init__(self, **kwargs):
         self.mime_type = kwargs["mime_type"]
         self.date = kwargs["date"]
 
 
-class MockEventLoop:
-    def __init__(self):
-        pass
-
-    def run_until_complete(self, *args, **kwargs):
-        return {"api_id": 1, "api_hash": "asdf", "ids_to_retry": [1, 2, 3]}
+CHAT_HISTORY = (
+    MockMessage(
+        id=1213,
+        media=True,
+        voice=MockVoice(
+            mime_type="audio/ogg",
+            date=MOCK_VOICE_DATE,
+        ),
+    ),
+    MockMessage(
+        id=1214,
+        media=False,
+        text="test message 1",
+    ),
+    MockMessage(
+        id=1215,
+        media=False,
+        text="test message 2",
+    ),
+    MockMessage(
+        id=1216,
+        media=False,
+        text="test message 3",
+    ),
+)
+GET_MESSAGES_RESPONSES = {
+    7: MockMessage(
+        id=7,
+        media=True,
+        chat_id=123456,
+        video=MockVideo(
+            file_name="sample_video.mov",
+            mime_type="video/mov",
+        ),
+    ),
+    8: MockMessage(
+        id=8,
+        media=True,
+        chat_id=234567,
+        video=MockVideo(
+            file_name="sample_video.mov",
+            mime_type="video/mov",
+        ),
+    ),
+    (1,): (
+        MockMessage(
+            id=1,
+            media=True,
+            chat_id=234568,
+            video=MockVideo(
+                file_name="sample_video.mov",
+                mime_type="video/mov",
+            ),
+        ),
+    ),
+}
+GET_MEDIA_META_CASES = (
+    (
+        "voice",
+        MockVoice(mime_type="audio/ogg", date=MOCK_VOICE_DATE),
+        (
+            platform_generic_path("/root/project/voice/voice_2019-07-25T14:53:50.ogg"),
+            "ogg",
+        ),
+    ),
+    (
+        "photo",
+        MockPhoto(date=MOCK_PHOTO_DATE),
+        (platform_generic_path("/root/project/photo/"), None),
+    ),
+    (
+        "document",
+        MockDocument(file_name="sample_document.pdf", mime_type="application/pdf"),
+        (platform_generic_path("/root/project/document/sample_document.pdf"), "pdf"),
+    ),
+    (
+        "audio",
+        MockAudio(file_name="sample_audio.mp3", mime_type="audio/mp3"),
+        (platform_generic_path("/root/project/audio/sample_audio.mp3"), "mp3"),
+    ),
+    (
+        "video",
+        MockVideo(mime_type="video/mp4"),
+        (platform_generic_path("/root/project/video/"), "mp4"),
+    ),
+    (
+        "video_note",
+        MockVideoNote(mime_type="video/mp4", date=MOCK_VOICE_DATE),
+        (
+            platform_generic_path(
+                "/root/project/video_note/video_note_2019-07-25T14:53:50.mp4"
+            ),
+            "mp4",
+        ),
+    ),
+)
+CAN_DOWNLOAD_FILE_FORMATS = {
+    "audio": ["mp3"],
+    "video": ["mp4"],
+    "document": ["all"],
+}
+CAN_DOWNLOAD_FROZEN_FILE_FORMATS = {
+    "audio": frozenset(["mp3", "ogg"]),
+    "video": frozenset(["all"]),
+}
+CAN_DOWNLOAD_CASES = (
+    ("audio", CAN_DOWNLOAD_FILE_FORMATS, "mp3", True),
+    ("audio", CAN_DOWNLOAD_FILE_FORMATS, "ogg", False),
+    ("document", CAN_DOWNLOAD_FILE_FORMATS, "pdf", True),
+    ("document", CAN_DOWNLOAD_FILE_FORMATS, "epub", True),
+    ("audio", CAN_DOWNLOAD_FROZEN_FILE_FORMATS, "ogg", True),
+    ("audio", CAN_DOWNLOAD_FROZEN_FILE_FORMATS, "flac", False),
+    ("video", CAN_DOWNLOAD_FROZEN_FILE_FORMATS, "mkv", True),
+)
 
 
 class MockAsync:
     def __init__(self):
         pass
 
-    def get_event_loop(self):
-        return MockEventLoop()
-
-
-async def async_get_media_meta(message_media, _type):
-    result = await _get_media_meta(message_media, _type)
-    return result
-
-
-async def async_download_media(client, message, media_types, file_formats):
-    result = await download_media(client, message, media_types, file_formats)
-    return result
-
+    def set_event_loop_policy(self, policy):
+        pass
 
-async def async_begin_import(conf, pagination_limit):
-    result = await begin_import(conf, pagination_limit)
-    return result
+    def run(self, coro):
+        coro.close()
+        return {"api_id": 1, "api_hash": "asdf", "ids_to_retry": [1, 2, 3]}
 
 
 async def mock_process_message(*args, **kwargs):
     return 5
 
 
-async def async_process_messages(client, messages, media_types, file_formats):
-    result = await process_messages(client, messages, media_types, file_formats)
-    return result
-
-
 class MockClient:
     def __init__(self, *args, **kwargs):
         pass
@@ -151,68 +286,21 @@ class MockClient:
         pass
 
     async def get_chat_history(self, *args, **kwargs):
-        items = [
-            MockMessage(
-                id=1213,
-                media=True,
-                voice=MockVoice(
-                    mime_type="audio/ogg",
-                    date=datetime(2019, 7, 25, 14, 53, 50),
-                ),
-            ),
-            MockMessage(
-                id=1214,
-                media=False,
-                text="test message 1",
-            ),
-            MockMessage(
-                id=1215,
-                media=False,
-                text="test message 2",
-            ),
-            MockMessage(
-                id=1216,
-                media=False,
-                text="test message 3",
-            ),
-        ]
-        for item in items:
+        for item in CHAT_HISTORY:
             yield item
 
     async def get_messages(self, *args, **kwargs):
-        if kwargs["message_ids"] == 7:
-            message = MockMessage(
-                id=7,
-                media=True,
-                chat_id=123456,
-                video=MockVideo(
-                    file_name="sample_video.mov",
-                    mime_type="video/mov",
-                ),
-            )
-        elif kwargs["message_ids"] == 8:
-            message = MockMessage(
-                id=8,
-                media=True,
-                chat_id=234567,
-                video=MockVideo(
-                    file_name="sample_video.mov",
-                    mime_type="video/mov",
-                ),
-            )
-        elif kwargs["message_ids"] == [1]:
-            message = [
-                MockMessage(
-                    id=1,
-                    media=True,
-                    chat_id=234568,
-                    video=MockVideo(
-                        file_name="sample_video.mov",
-                        mime_type="video/mov",
-                    ),
-                )
-            ]
-        return message
+        message_ids = kwargs["message_ids"]
+        if isinstance(message_ids, list):
+            return list(GET_MESSAGES_RESPONSES[tuple(message_ids)])
+        return GET_MESSAGES_RESPONSES[message_ids]
+
+    async def stream_media(self, message, limit=0, offset=0):
+        chunk_size = media_downloader.CHUNK_SIZE
+        start = offset * chunk_size
+        stop = (offset + limit) * chunk_size if limit else len(MOCK_FILE_CONTENT)
+        for position in range(start, min(stop, len(MOCK_FILE_CONTENT)), chunk_size):
+            yield MOCK_FILE_CONTENT[position : position + chunk_size]
 
     async def download_media(self, *args, **kwargs):
         mock_message = args[0]
@@ -225,171 +313,201 @@ class MockClient:
         return kwargs["file_name"]
 
 
+def setUpModule():
+    global EVENT_LOOP, EVENT_LOOP_POLICY
+    EVENT_LOOP_POLICY = asyncio.get_event_loop_policy()
+    if media_downloader.uvloop is not None:
+        asyncio.set_event_loop_policy(media_downloader.uvloop.EventLoopPolicy())
+    EVENT_LOOP = asyncio.new_event_loop()
+    asyncio.set_event_loop(EVENT_LOOP)
+
+
+def tearDownModule():
+    EVENT_LOOP.close()
+    asyncio.set_event_loop_policy(EVENT_LOOP_POLICY)
+
+
 class MediaDownloaderTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        cls.loop = asyncio.get_event_loop()
+        cls.loop = EVENT_LOOP
+        cls.client = MockClient()
+        cls.messages = {
+            5: MockMessage(
+                id=5,
+                media=True,
+                video=MockVideo(
+                    file_name="sample_video.mp4",
+                    mime_type="video/mp4",
+                ),
+            ),
+            10: MockMessage(
+                id=10,
+                media=None,
+            ),
+        }
+        for message_id in (6, 7, 8, 9, 11):
+            cls.messages[message_id] = MockMessage(
+                id=message_id,
+                media=True,
+                video=MockVideo(
+                    file_name="sample_video.mov",
+                    mime_type="video/mov",
+                ),
+            )
 
     @mock.patch("media_downloader.THIS_DIR", new=MOCK_DIR)
     def test_get_media_meta(self):
-        # Test Voice notes
-        message = MockMessage(
-            id=1,
-            media=True,
-            voice=MockVoice(
-                mime_type="audio/ogg",
-                date=datetime(2019, 7, 25, 14, 53, 50),
-            ),
-        )
-        result = self.loop.run_until_complete(
-            async_get_media_meta(message.voice, "voice")
-        )
-
-        self.assertEqual(
-            (
-                platform_generic_path(
-                    "/root/project/voice/voice_2019-07-25T14:53:50.ogg"
-                ),
-                "ogg",
-            ),
-            result,
-        )
+        for _type, media_obj, expected in GET_MEDIA_META_CASES:
+            with self.subTest(_type=_type):
+                self.assertEqual(expected, _get_media_meta(media_obj, _type))
 
-        # Test photos
-        message = MockMessage(
-            id=2,
-            media=True,
-            photo=MockPhoto(date=datetime(2019, 8, 5, 14, 35, 12)),
-        )
-        result = self.loop.run_until_complete(
-            async_get_media_meta(message.photo, "photo")
+    @mock.patch("media_downloader.THIS_DIR", new=MOCK_DIR)
+    @mock.patch("media_downloader.asyncio.sleep", return_value=None)
+    @mock.patch("media_downloader.logger")
+    def test_download_media(self, mock_logger, patched_time_sleep):
+        # Message 7 re-fetch succeeds, 8 re-fetch fails, 9 raises another
+        # exception, 10 has no media and 11 times out.
+        file_formats = {message_id: {"video": ["all"]} for message_id in range(6, 12)}
+        file_formats[5] = {"video": ["mp4"]}
+        results = self.loop.run_until_complete(
+            asyncio.gather(
+                *(
+                    download_media(
+                        self.client,
+                        self.messages[message_id],
+                        ["video", "photo"],
+                        file_formats[message_id],
+                    )
+                    for message_id in range(5, 12)
+                )
+            )
         )
-        self.assertEqual(
-            (
-                platform_generic_path("/root/project/photo/"),
-                None,
-            ),
-            result,
+        self.assertEqual([5, 6, 7, 8, 9, 10, 11], results)
+        mock_logger.warning.assert_any_call(
+            "Message[%d]: file reference expired, refetching...", 7
         )
-
-        # Test Documents
-        message = MockMessage(
-            id=3,
-            media=True,
-            document=MockDocument(
-                file_name="sample_document.pdf",
-                mime_type="application/pdf",
-            ),
+        mock_logger.error.assert_any_call(
+            "Message[%d]: file reference expired for 3 retries, download skipped.",
+            8,
         )
-        result = self.loop.run_until_complete(
-            async_get_media_meta(message.document, "document")
+        mock_logger.error.assert_any_call(
+            "Message[%d]: could not be downloaded due to following exception:\n[%s].",
+            9,
+            mock.ANY,
+            exc_info=True,
         )
-        self.assertEqual(
-            (
-                platform_generic_path("/root/project/document/sample_document.pdf"),
-                "pdf",
-            ),
-            result,
+        mock_logger.error.assert_any_call(
+            "Message[%d]: Timing out after 3 reties, download skipped.", 11
         )
 
-        # Test audio
-        message = MockMessage(
-            id=4,
-            media=True,
-            audio=MockAudio(
-                file_name="sample_audio.mp3",
-                mime_type="audio/mp3",
-            ),
-        )
-        result = self.loop.run_until_complete(
-            async_get_media_meta(message.audio, "audio")
-        )
-        self.assertEqual(
-            (
-                platform_generic_path("/root/project/audio/sample_audio.mp3"),
-                "mp3",
-            ),
-            result,
-        )
+    @mock.patch("media_downloader.CREATED_DIRS", set())
+    def test_ensure_dir(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            directory = os.path.join(temp_dir, "chat", "video")
+            self.loop.run_until_complete(_ensure_dir(directory))
+            self.assertTrue(os.path.isdir(directory))
 
-        # Test Video
+            with mock.patch("media_downloader.os.makedirs") as mock_makedirs:
+                self.loop.run_until_complete(_ensure_dir(directory))
+            mock_makedirs.assert_not_called()
+
+    @mock.patch("media_downloader.CHUNK_SIZE", new=4)
+    def test_parallel_download(self):
         message = MockMessage(
-            id=5,
+            id=12,
             media=True,
             video=MockVideo(
+                file_name="sample_video.mp4",
                 mime_type="video/mp4",
             ),
         )
-        result = self.loop.run_until_complete(
-            async_get_media_meta(message.video, "video")
-        )
-        self.assertEqual(
-            (
-                platform_generic_path("/root/project/video/"),
-                "mp4",
-            ),
-            result,
-        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_name = os.path.join(temp_dir, "video", "sample_video.mp4")
+            result = self.loop.run_until_complete(
+                _parallel_download(
+                    self.client, message, file_name, len(MOCK_FILE_CONTENT), workers=3
+                )
+            )
+            self.assertEqual(file_name, result)
+            with open(file_name, "rb") as downloaded_file:
+                self.assertEqual(MOCK_FILE_CONTENT, downloaded_file.read())
+            self.assertEqual(
+                [file_name],
+                [
+                    os.path.join(temp_dir, "video", name)
+                    for name in os.listdir(os.path.join(temp_dir, "video"))
+                ],
+            )
 
-        # Test VideoNote
-        message = MockMessage(
-            id=6,
-            media=True,
-            video_note=MockVideoNote(
-                mime_type="video/mp4",
-                date=datetime(2019, 7, 25, 14, 53, 50),
-            ),
-        )
-        result = self.loop.run_until_complete(
-            async_get_media_meta(message.video_note, "video_note")
-        )
-        self.assertEqual(
-            (
-                platform_generic_path(
-                    "/root/project/video_note/video_note_2019-07-25T14:53:50.mp4"
-                ),
-                "mp4",
-            ),
-            result,
-        )
+    def test_download_file(self):
+        threshold = media_downloader.PARALLEL_DOWNLOAD_THRESHOLD
+        file_name = platform_generic_path("/root/project/document/sample.pdf")
+        photo_name = platform_generic_path("/root/project/photo/")
+        cases = (
+            ("large file", threshold, file_name, 4, True),
+            ("small file", threshold - 1, file_name, 4, False),
+            ("unknown size", None, file_name, 4, False),
+            ("no base name", threshold, photo_name, 4, False),
+            ("serial transmissions", threshold, file_name, 1, False),
+        )
+        for name, file_size, path, transmissions, parallel in cases:
+            with self.subTest(name=name):
+                media_obj = MockDocument(
+                    file_name="sample.pdf",
+                    mime_type="application/pdf",
+                    file_size=file_size,
+                )
+                with mock.patch(
+                    "media_downloader._parallel_download", return_value=path
+                ) as mock_parallel_download, mock.patch.object(
+                    self.client,
+                    "max_concurrent_transmissions",
+                    transmissions,
+                    create=True,
+                ):
+                    result = self.loop.run_until_complete(
+                        _download_file(self.client, MockMessage(id=12), media_obj, path)
+                    )
+                self.assertEqual(path, result)
+                if parallel:
+                    mock_parallel_download.assert_called_once_with(
+                        self.client, mock.ANY, path, file_size
+                    )
+                else:
+                    mock_parallel_download.assert_not_called()
+
+    @mock.patch("media_downloader.CHUNK_SIZE", new=4)
+    def test_parallel_download_incomplete(self):
+        async def short_stream_media(message, limit=0, offset=0):
+            # The range starting at chunk 3 ends one chunk early.
+            if offset == 3:
+                limit -= 1
+            async for chunk in MockClient.stream_media(
+                self.client, message, limit=limit, offset=offset
+            ):
+                yield chunk
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_name = os.path.join(temp_dir, "video", "sample_video.mp4")
+            with mock.patch.object(self.client, "stream_media", new=short_stream_media):
+                with self.assertRaises(ConnectionError):
+                    self.loop.run_until_complete(
+                        _parallel_download(
+                            self.client,
+                            MockMessage(id=12, media=True),
+                            file_name,
+                            len(MOCK_FILE_CONTENT),
+                            workers=3,
+                        )
+                    )
+            self.assertEqual([], os.listdir(os.path.join(temp_dir, "video")))
 
     @mock.patch("media_downloader.THIS_DIR", new=MOCK_DIR)
     @mock.patch("media_downloader.asyncio.sleep", return_value=None)
     @mock.patch("media_downloader.logger")
-    def test_download_media(self, mock_logger, patched_time_sleep):
-        client = MockClient()
+    def test_download_media_meta_computed_once(self, mock_logger, patched_sleep):
         message = MockMessage(
-            id=5,
-            media=True,
-            video=MockVideo(
-                file_name="sample_video.mp4",
-                mime_type="video/mp4",
-            ),
-        )
-        result = self.loop.run_until_complete(
-            async_download_media(
-                client, message, ["video", "photo"], {"video": ["mp4"]}
-            )
-        )
-        self.assertEqual(5, result)
-
-        message_1 = MockMessage(
-            id=6,
-            media=True,
-            video=MockVideo(
-                file_name="sample_video.mov",
-                mime_type="video/mov",
-            ),
-        )
-        result = self.loop.run_until_complete(
-            async_download_media(
-                client, message_1, ["video", "photo"], {"video": ["all"]}
-            )
-        )
-        self.assertEqual(6, result)
-
-        # Test re-fetch message success
-        message_2 = MockMessage(
             id=7,
             media=True,
             video=MockVideo(
@@ -397,181 +515,312 @@ class MediaDownloaderTestCase(unittest.TestCase):
                 mime_type="video/mov",
             ),
         )
-        result = self.loop.run_until_complete(
-            async_download_media(
-                client, message_2, ["video", "photo"], {"video": ["all"]}
+        with mock.patch(
+            "media_downloader._get_media_meta", wraps=_get_media_meta
+        ) as mock_get_media_meta:
+            result = self.loop.run_until_complete(
+                download_media(self.client, message, ["video"], {"video": ["all"]})
             )
-        )
         self.assertEqual(7, result)
-        mock_logger.warning.assert_called_with(
-            "Message[%d]: file reference expired, refetching...", 7
-        )
+        self.assertEqual(2, mock_logger.warning.call_count)
+        mock_get_media_meta.assert_called_once()
 
-        # Test re-fetch message failure
-        message_3 = MockMessage(
-            id=8,
-            media=True,
-            video=MockVideo(
-                file_name="sample_video.mov",
-                mime_type="video/mov",
-            ),
-        )
-        result = self.loop.run_until_complete(
-            async_download_media(
-                client, message_3, ["video", "photo"], {"video": ["all"]}
-            )
-        )
-        self.assertEqual(8, result)
-        mock_logger.error.assert_called_with(
-            "Message[%d]: file reference expired for 3 retries, download skipped.",
-            8,
-        )
+    @mock.patch("media_downloader.THIS_DIR", new=MOCK_DIR)
+    @mock.patch("media_downloader.FAILED_IDS", set())
+    @mock.patch("media_downloader.asyncio.sleep", return_value=None)
+    @mock.patch("media_downloader.logger")
+    def test_download_media_no_backoff_after_last_retry(
+        self, mock_logger, patched_sleep
+    ):
+        # Message 8 keeps failing with an expired file reference and
+        # message 11 keeps timing out.
+        for message_id in (8, 11):
+            with self.subTest(message_id=message_id):
+                patched_sleep.reset_mock()
+                with mock.patch.object(
+                    self.client, "get_messages", wraps=self.client.get_messages
+                ) as mock_get_messages:
+                    result = self.loop.run_until_complete(
+                        download_media(
+                            self.client,
+                            self.messages[message_id],
+                            ["video"],
+                            {"video": ["all"]},
+                        )
+                    )
+                self.assertEqual(message_id, result)
+                self.assertIn(message_id, media_downloader.FAILED_IDS)
+                self.assertEqual(2, patched_sleep.call_count)
+                self.assertEqual(
+                    2 if message_id == 8 else 0, mock_get_messages.call_count
+                )
 
-        # Test other exception
-        message_4 = MockMessage(
-            id=9,
-            media=True,
-            video=MockVideo(
-                file_name="sample_video.mov",
-                mime_type="video/mov",
-            ),
-        )
-        result = self.loop.run_until_complete(
-            async_download_media(
-                client, message_4, ["video", "photo"], {"video": ["all"]}
-            )
-        )
-        self.assertEqual(9, result)
-        mock_logger.error.assert_called_with(
-            "Message[%d]: could not be downloaded due to following exception:\n[%s].",
-            9,
-            mock.ANY,
-            exc_info=True,
-        )
+    def _read_config_dir(self, config_file):
+        config_dir = os.path.dirname(config_file)
+        with open(config_file) as yaml_file:
+            return yaml_file.read(), os.listdir(config_dir)
 
-        # Check no media
-        message_5 = MockMessage(
-            id=10,
-            media=None,
-        )
-        result = self.loop.run_until_complete(
-            async_download_media(
-                client, message_5, ["video", "photo"], {"video": ["all"]}
+    @mock.patch("media_downloader._LAST_WRITTEN_CONFIG", None)
+    @mock.patch("media_downloader.yaml.dump", return_value="api_id: 123\n")
+    def test_update_config(self, mock_dump):
+        conf = {
+            "api_id": 123,
+            "api_hash": "hasw5Tgawsuj67",
+            "ids_to_retry": [],
+        }
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_file = os.path.join(temp_dir, "config.yaml")
+            with open(config_file, "w") as yaml_file:
+                yaml_file.write("api_id: 1\n")
+            os.chmod(config_file, 0o600)
+            with mock.patch("media_downloader.CONFIG_FILE", new=config_file):
+                update_config(conf)
+            self.assertEqual(
+                ("api_id: 123\n", ["config.yaml"]),
+                self._read_config_dir(config_file),
             )
-        )
-        self.assertEqual(10, result)
-
-        # Test timeout
-        message_6 = MockMessage(
-            id=11,
-            media=True,
-            video=MockVideo(
-                file_name="sample_video.mov",
-                mime_type="video/mov",
-            ),
-        )
-        result = self.loop.run_until_complete(
-            async_download_media(
-                client, message_6, ["video", "photo"], {"video": ["all"]}
+            if not IS_WINDOWS:
+                self.assertEqual(0o600, stat.S_IMODE(os.stat(config_file).st_mode))
+        mock_dump.assert_called_with(conf, Dumper=mock.ANY, default_flow_style=False)
+
+    @unittest.skipIf(IS_WINDOWS, "symlinks need extra privileges on Windows")
+    @mock.patch("media_downloader._LAST_WRITTEN_CONFIG", None)
+    @mock.patch("media_downloader.yaml.dump", return_value="api_id: 123\n")
+    def test_update_config_symlink(self, mock_dump):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            os.mkdir(os.path.join(temp_dir, "real"))
+            config_file = os.path.join(temp_dir, "real", "config.yaml")
+            with open(config_file, "w") as yaml_file:
+                yaml_file.write("api_id: 1\n")
+            config_link = os.path.join(temp_dir, "config.yaml")
+            os.symlink(config_file, config_link)
+            with mock.patch("media_downloader.CONFIG_FILE", new=config_link):
+                update_config({"ids_to_retry": []})
+            self.assertTrue(os.path.islink(config_link))
+            self.assertEqual(
+                ("api_id: 123\n", ["config.yaml"]),
+                self._read_config_dir(config_file),
             )
-        )
-        self.assertEqual(11, result)
-        mock_logger.error.assert_called_with(
-            "Message[%d]: Timing out after 3 reties, download skipped.", 11
-        )
 
-    @mock.patch("__main__.__builtins__.open", new_callable=mock.mock_open)
-    @mock.patch("media_downloader.yaml", autospec=True)
-    def test_update_config(self, mock_yaml, mock_open):
+    @mock.patch("media_downloader._LAST_WRITTEN_CONFIG", None)
+    @mock.patch("media_downloader.os.replace", wraps=os.replace)
+    def test_update_config_unchanged(self, mock_replace):
         conf = {
             "api_id": 123,
             "api_hash": "hasw5Tgawsuj67",
             "ids_to_retry": [],
         }
-        update_config(conf)
-        mock_open.assert_called_with("config.yaml", "w")
-        mock_yaml.dump.assert_called_with(conf, mock.ANY, default_flow_style=False)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_file = os.path.join(temp_dir, "config.yaml")
+            with mock.patch("media_downloader.CONFIG_FILE", new=config_file):
+                update_config(conf)
+                update_config(conf)
+                self.assertEqual(1, mock_replace.call_count)
+
+                conf["last_read_message_id"] = 5
+                update_config(conf)
+            self.assertEqual(2, mock_replace.call_count)
+            self.assertIn(
+                "last_read_message_id: 5\n", self._read_config_dir(config_file)[0]
+            )
+
+    @mock.patch("media_downloader._LAST_WRITTEN_CONFIG", None)
+    @mock.patch("media_downloader.os.replace", side_effect=OSError)
+    def test_update_config_failed_write(self, mock_replace):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_file = os.path.join(temp_dir, "config.yaml")
+            with mock.patch("media_downloader.CONFIG_FILE", new=config_file):
+                with self.assertRaises(OSError):
+                    update_config({"ids_to_retry": []})
+            self.assertEqual([], os.listdir(temp_dir))
+        self.assertEqual(None, media_downloader._LAST_WRITTEN_CONFIG)
+
+    @mock.patch("media_downloader._LAST_WRITTEN_CONFIG", None)
+    @mock.patch("media_downloader.DOWNLOADED_IDS", {1, 4})
+    @mock.patch("media_downloader.FAILED_IDS", {6, 2})
+    def test_update_config_ids_to_retry(self):
+        conf = {
+            "api_id": 123,
+            "api_hash": "hasw5Tgawsuj67",
+            "ids_to_retry": [5, 1, 3],
+        }
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config_file = os.path.join(temp_dir, "config.yaml")
+            with mock.patch("media_downloader.CONFIG_FILE", new=config_file):
+                update_config(conf)
+        self.assertEqual([2, 3, 5, 6], conf["ids_to_retry"])
 
+    @mock.patch("media_downloader._ensure_dir")
     @mock.patch("media_downloader.update_config")
     @mock.patch("media_downloader.pyrogram.Client", new=MockClient)
     @mock.patch("media_downloader.process_messages", new=mock_process_message)
-    def test_begin_import(self, mock_update_config):
-        result = self.loop.run_until_complete(async_begin_import(MOCK_CONF, 3))
+    def test_begin_import(self, mock_update_config, mock_ensure_dir):
+        result = self.loop.run_until_complete(begin_import(MOCK_CONF, 3))
         conf = copy.deepcopy(MOCK_CONF)
         conf["last_read_message_id"] = 5
         self.assertDictEqual(result, conf)
+        mock_update_config.assert_not_called()
+        mock_ensure_dir.assert_has_awaits(
+            [
+                mock.call(os.path.join(media_downloader.THIS_DIR, "audio")),
+                mock.call(os.path.join(media_downloader.THIS_DIR, "voice")),
+            ],
+            any_order=True,
+        )
+
+    @mock.patch("media_downloader._ensure_dir")
+    @mock.patch("media_downloader.update_config")
+    @mock.patch("media_downloader.process_messages", new=mock_process_message)
+    def test_begin_import_max_concurrent_transmissions(
+        self, mock_update_config, mock_ensure_dir
+    ):
+        clients: list = []
+
+        class MockTransmissionClient(MockClient):
+            def __init__(self, *args, max_concurrent_transmissions=1, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.max_concurrent_transmissions = max_concurrent_transmissions
+                clients.append(self)
+
+        for max_concurrent_downloads, transmissions in ((2, 4), (8, 8)):
+            with self.subTest(max_concurrent_downloads=max_concurrent_downloads):
+                conf = copy.deepcopy(MOCK_CONF)
+                conf["max_concurrent_downloads"] = max_concurrent_downloads
+                with mock.patch(
+                    "media_downloader.pyrogram.Client", new=MockTransmissionClient
+                ):
+                    self.loop.run_until_complete(begin_import(conf, 3))
+                self.assertEqual(
+                    transmissions, clients[-1].max_concurrent_transmissions
+                )
+
+    @mock.patch("media_downloader._ensure_dir")
+    @mock.patch("media_downloader.update_config")
+    @mock.patch("media_downloader.pyrogram.Client", new=MockClient)
+    def test_begin_import_batches(self, mock_update_config, mock_ensure_dir):
+        batches: list = []
+
+        concurrency: list = []
+
+        async def mock_process_messages(
+            client, messages, media_types, file_formats, max_concurrent_downloads
+        ):
+            batches.append([message.id for message in messages])
+            concurrency.append(max_concurrent_downloads)
+            return max(batches[-1])
+
+        with mock.patch("media_downloader.process_messages", new=mock_process_messages):
+            conf = copy.deepcopy(MOCK_CONF)
+            conf["max_concurrent_downloads"] = 2
+            result = self.loop.run_until_complete(begin_import(conf, 3))
+        self.assertEqual([[1, 1213, 1214], [1215, 1216]], batches)
+        self.assertEqual(1216, result["last_read_message_id"])
+        self.assertEqual([2, 2], concurrency)
+
+    def test_get_max_concurrent_downloads(self):
+        self.assertEqual(
+            media_downloader.MAX_CONCURRENT_DOWNLOADS,
+            _get_max_concurrent_downloads({}),
+        )
+        self.assertEqual(
+            1, _get_max_concurrent_downloads({"max_concurrent_downloads": 1})
+        )
+        for value in (0, -2, 1.5, "4", True, None):
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    _get_max_concurrent_downloads({"max_concurrent_downloads": value})
+
+    @mock.patch("media_downloader.pyrogram.Client")
+    def test_begin_import_invalid_concurrency(self, mock_client):
+        conf = copy.deepcopy(MOCK_CONF)
+        conf["max_concurrent_downloads"] = 0
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(begin_import(conf, 3))
+        mock_client.assert_not_called()
+
+    @mock.patch("media_downloader.CONFIG_WRITE_INTERVAL", new=0)
+    @mock.patch("media_downloader._ensure_dir")
+    @mock.patch("media_downloader._write_config")
+    @mock.patch("media_downloader.pyrogram.Client", new=MockClient)
+    @mock.patch("media_downloader.process_messages", new=mock_process_message)
+    def test_begin_import_checkpoints_config(self, mock_write_config, mock_ensure_dir):
+        self.loop.run_until_complete(begin_import(copy.deepcopy(MOCK_CONF), 3))
+        self.assertEqual(2, mock_write_config.call_count)
+        self.assertIn("last_read_message_id: 5\n", mock_write_config.call_args[0][0])
+
+    @mock.patch("media_downloader.CONFIG_WRITE_INTERVAL", new=0)
+    @mock.patch("media_downloader._ensure_dir")
+    @mock.patch("media_downloader.pyrogram.Client", new=MockClient)
+    @mock.patch("media_downloader.process_messages", new=mock_process_message)
+    def test_begin_import_cancelled_during_checkpoint(self, mock_ensure_dir):
+        writes: list = []
+        write_started = threading.Event()
+
+        def mock_write_config(config_yaml):
+            writes.append("start")
+            write_started.set()
+            time.sleep(0.05)
+            writes.append("end")
+
+        async def cancel_during_checkpoint():
+            import_task = asyncio.ensure_future(
+                begin_import(copy.deepcopy(MOCK_CONF), 3)
+            )
+            while not write_started.is_set():
+                await asyncio.sleep(0.001)
+            import_task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await import_task
+
+        with mock.patch(
+            "media_downloader._write_config", side_effect=mock_write_config
+        ):
+            self.loop.run_until_complete(cancel_during_checkpoint())
+        # The final write only starts once the checkpoint has finished.
+        self.assertEqual(["start", "end", "start", "end"], writes)
 
     def test_process_message(self):
-        client = MockClient()
         result = self.loop.run_until_complete(
-            async_process_messages(
-                client,
-                [
-                    MockMessage(
-                        id=1213,
-                        media=True,
-                        voice=MockVoice(
-                            mime_type="audio/ogg",
-                            date=datetime(2019, 7, 25, 14, 53, 50),
-                        ),
-                    ),
-                    MockMessage(
-                        id=1214,
-                        media=False,
-                        text="test message 1",
-                    ),
-                    MockMessage(
-                        id=1215,
-                        media=False,
-                        text="test message 2",
-                    ),
-                    MockMessage(
-                        id=1216,
-                        media=False,
-                        text="test message 3",
-                    ),
-                ],
+            process_messages(
+                self.client,
+                list(CHAT_HISTORY),
                 ["voice", "photo"],
                 {"audio": ["all"], "voice": ["all"]},
             )
         )
         self.assertEqual(result, 1216)
 
-    @mock.patch("media_downloader._is_exist", return_value=True)
+    def test_process_message_concurrency_limit(self):
+        running: list = []
+        max_running: list = []
+
+        async def mock_download_media(client, message, *args):
+            running.append(message.id)
+            max_running.append(len(running))
+            await asyncio.sleep(0)
+            running.remove(message.id)
+            return message.id
+
+        messages = [MockMessage(id=i, media=False) for i in range(1, 11)]
+        with mock.patch("media_downloader.download_media", new=mock_download_media):
+            result = self.loop.run_until_complete(
+                process_messages(
+                    self.client, messages, ["voice"], {}, max_concurrent_downloads=3
+                )
+            )
+        self.assertEqual(10, result)
+        self.assertEqual(3, max(max_running))
+
+    @mock.patch("media_downloader._stat_file", return_value=os.stat(__file__))
     @mock.patch(
         "media_downloader.manage_duplicate_file",
         new=mock_manage_duplicate_file,
     )
-    def test_process_message_when_file_exists(self, mock_is_exist):
-        client = MockClient()
+    def test_process_message_when_file_exists(self, mock_stat_file):
         result = self.loop.run_until_complete(
-            async_process_messages(
-                client,
-                [
-                    MockMessage(
-                        id=1213,
-                        media=True,
-                        voice=MockVoice(
-                            mime_type="audio/ogg",
-                            date=datetime(2019, 7, 25, 14, 53, 50),
-                        ),
-                    ),
-                    MockMessage(
-                        id=1214,
-                        media=False,
-                        text="test message 1",
-                    ),
-                    MockMessage(
-                        id=1215,
-                        media=False,
-                        text="test message 2",
-                    ),
-                    MockMessage(
-                        id=1216,
-                        media=False,
-                        text="test message 3",
-                    ),
-                ],
+            process_messages(
+                self.client,
+                list(CHAT_HISTORY),
                 ["voice", "photo"],
                 {"audio": ["all"], "voice": ["all"]},
             )
@@ -579,36 +828,86 @@ class MediaDownloaderTestCase(unittest.TestCase):
         self.assertEqual(result, 1216)
 
     def test_can_download(self):
-        file_formats = {
-            "audio": ["mp3"],
-            "video": ["mp4"],
-            "document": ["all"],
-        }
-        result = _can_download("audio", file_formats, "mp3")
-        self.assertEqual(result, True)
-
-        result1 = _can_download("audio", file_formats, "ogg")
-        self.assertEqual(result1, False)
+        for _type, file_formats, file_format, expected in CAN_DOWNLOAD_CASES:
+            with self.subTest(_type=_type, file_format=file_format):
+                self.assertEqual(
+                    expected, _can_download(_type, file_formats, file_format)
+                )
 
-        result2 = _can_download("document", file_formats, "pdf")
-        self.assertEqual(result2, True)
+    def test_get_message_media(self):
+        video = MockVideo(mime_type="video/mp4")
+        message = MockMessage(id=1, media=True, video=video)
+        result = _get_message_media(message, ["photo", "video"])
+        self.assertEqual(("video", video), result)
 
-        result3 = _can_download("document", file_formats, "epub")
-        self.assertEqual(result3, True)
+        result1 = _get_message_media(message, ["photo", "audio"])
+        self.assertEqual(("", None), result1)
 
-    def test_is_exist(self):
-        this_dir = os.path.dirname(os.path.abspath(__file__))
-        result = _is_exist(os.path.join(this_dir, "__init__.py"))
-        self.assertEqual(result, True)
+        result2 = _get_message_media(MockMessage(id=2, media=None), ["video"])
+        self.assertEqual(("", None), result2)
 
-        result1 = _is_exist(os.path.join(this_dir, "init.py"))
-        self.assertEqual(result1, False)
+    @mock.patch("media_downloader.random.uniform", return_value=1.0)
+    def test_get_retry_delay(self, mock_uniform):
+        self.assertEqual(
+            [5.0, 10.0, 20.0, 40.0, 60.0],
+            [_get_retry_delay(retry) for retry in range(5)],
+        )
+        mock_uniform.assert_called_with(0.9, 1.1)
 
-        result2 = _is_exist(this_dir)
-        self.assertEqual(result2, False)
+    def test_stat_file(self):
+        this_dir = os.path.dirname(os.path.abspath(__file__))
+        file_stat = _stat_file(os.path.abspath(__file__))
+        self.assertEqual(os.path.getsize(__file__), file_stat.st_size)
+        self.assertIsNotNone(_stat_file(os.path.join(this_dir, "__init__.py")))
+        self.assertEqual(None, _stat_file(os.path.join(this_dir, "init.py")))
+        self.assertEqual(None, _stat_file(this_dir))
+        self.assertEqual(None, _stat_file("invalid\0path"))
+
+    def test_would_be_duplicate(self):
+        file_stat = os.stat(__file__)
+        file_size = file_stat.st_size
+        self.assertEqual(_would_be_duplicate(file_stat, file_size), True)
+        self.assertEqual(_would_be_duplicate(file_stat, file_size + 1), False)
+        self.assertEqual(_would_be_duplicate(file_stat, None), False)
+        self.assertEqual(_would_be_duplicate(None, file_size), False)
+
+    @mock.patch("media_downloader.DOWNLOADED_IDS", set())
+    @mock.patch("media_downloader.FAILED_IDS", set())
+    @mock.patch("media_downloader._download_file")
+    @mock.patch("media_downloader.logger")
+    def test_download_media_skips_duplicate(self, mock_logger, mock_download_file):
+        message = MockMessage(
+            id=8,
+            media=True,
+            document=MockDocument(
+                file_name="sample_document.pdf",
+                mime_type="application/pdf",
+                file_size=len(MOCK_FILE_CONTENT),
+            ),
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_name = os.path.join(temp_dir, "document", "sample_document.pdf")
+            os.makedirs(os.path.dirname(file_name))
+            with open(file_name, "wb") as existing_file:
+                existing_file.write(MOCK_FILE_CONTENT)
+            with mock.patch("media_downloader.THIS_DIR", new=temp_dir):
+                result = self.loop.run_until_complete(
+                    download_media(
+                        self.client, message, ["document"], {"document": ["all"]}
+                    )
+                )
+        self.assertEqual(8, result)
+        self.assertEqual({8}, media_downloader.DOWNLOADED_IDS)
+        self.assertEqual(set(), media_downloader.FAILED_IDS)
+        mock_download_file.assert_not_called()
+        mock_logger.error.assert_not_called()
+        mock_logger.info.assert_called_once_with(
+            "Media already downloaded - %s", file_name
+        )
 
-    @mock.patch("media_downloader.FAILED_IDS", [2, 3])
-    @mock.patch("media_downloader.yaml.safe_load")
+    @mock.patch("media_downloader._LAST_WRITTEN_CONFIG", None)
+    @mock.patch("media_downloader.FAILED_IDS", {2, 3})
+    @mock.patch("media_downloader.yaml.load")
     @mock.patch("media_downloader.update_config", return_value=True)
     @mock.patch("media_downloader.begin_import")
     @mock.patch("media_downloader.asyncio", new=MockAsync())
@@ -623,7 +922,7 @@ class MediaDownloaderTestCase(unittest.TestCase):
         mock_import.assert_called_with(conf, pagination_limit=100)
         conf["ids_to_retry"] = [1, 2, 3]
         mock_update.assert_called_with(conf)
-
-    @classmethod
-    def tearDownClass(cls):
-        cls.loop.close()
+        self.assertEqual(
+            "api_hash: asdf\napi_id: 1\nids_to_retry:\n- 1\n- 2\n- 3\n",
+            media_downloader._LAST_WRITTEN_CONFIG,
+        )